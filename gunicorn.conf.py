@@ -0,0 +1,38 @@
+# ==============================================================================
+# Memory Library - Manual Workflow Trigger Service
+# gunicorn.conf.py
+#
+# Role:         Gunicornの設定ファイル。ワーカー起動時にクライアントを初期化し、
+#               コールドスタート後の最初のリクエストが初期化コストを負わないようにする。
+# ==============================================================================
+import os
+
+# --- Server ---
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+reuse_port = True
+
+# --- Workers ---
+# 処理はFirestore/Pub/SubのI/O待ちが大半のため、スレッドワーカーで多重化する
+worker_class = "gthread"
+workers = 2
+threads = 8
+timeout = 120
+max_requests = 10000
+max_requests_jitter = 500
+
+# 設定の読み込みと検証をmasterで一度だけ行い、ワーカーへはcopy-on-writeで引き継ぐ
+# （gRPCクライアントはfork後に生成する。post_forkを参照）
+preload_app = True
+
+
+def post_fork(server, worker):
+    """fork後の各ワーカーでFirestore/Pub/Subクライアントを事前に初期化する"""
+    # gRPCチャネルはforkを跨いで共有できないため、必ずfork後に生成する
+    from main import app, get_firestore_client, get_pubsub_publisher
+
+    try:
+        get_firestore_client()
+        get_pubsub_publisher(app.config["BATCH_SIZE"])
+    except Exception as e:
+        # 失敗してもワーカーは起動させ、最初のリクエスト時の遅延初期化に任せる
+        server.log.warning(f"クライアントの事前初期化に失敗しました (pid: {worker.pid}): {e}")
@@ -9,19 +9,26 @@
 # ==============================================================================
 
 # --- 標準ライブラリ ---
+import concurrent.futures
+import hashlib
+import itertools
 import json
 import logging
 import os
+import secrets
 import sys
-import uuid
+import threading
+import time
 from functools import wraps
+from json.encoder import encode_basestring_ascii
 from typing import Any, Dict, List
 
 # --- サードパーティライブラリ ---
+import cachetools
 import firebase_admin
 import google.auth.transport.requests
 from firebase_admin import firestore
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from google.cloud import pubsub_v1
 from google.oauth2 import id_token
 
@@ -37,41 +44,91 @@ class Config:
     COLLECTION_NAME = os.environ.get("COLLECTION_NAME", "staging_articles")
     BATCH_SIZE = os.environ.get("BATCH_SIZE", "50")
     MAX_DOCUMENTS_PER_REQUEST = os.environ.get("MAX_DOCUMENTS_PER_REQUEST", "500")
+    PUBLISH_TIMEOUT_SECONDS = os.environ.get("PUBLISH_TIMEOUT_SECONDS", "60")
+    MAX_CONCURRENT_CHUNKS = os.environ.get("MAX_CONCURRENT_CHUNKS", "10")
 
 
 # ==============================================================================
-# Client Initialization (Lazy Loading)
+# Client Initialization (Lazy Loading, warmed in gunicorn post_fork)
 # ==============================================================================
 db_client: firestore.Client = None
 publisher_client: pubsub_v1.PublisherClient = None
+# gthreadワーカーで複数スレッドが同時に初期化しないよう、生成処理を直列化する
+client_init_lock = threading.Lock()
+# 公開鍵取得用のHTTPセッション（コネクションプール）をリクエスト間で再利用する
+auth_request = google.auth.transport.requests.Request()
 
 def get_firestore_client() -> firestore.Client:
     """Firestoreクライアントをシングルトンとして初期化・取得する"""
     global db_client
     if db_client is None:
-        try:
-            if not firebase_admin._apps:
-                firebase_admin.initialize_app()
-            db_client = firestore.client()
-            logging.info("Firestoreクライアントの初期化に成功しました。")
-        except Exception as e:
-            logging.critical(f"Firebaseの初期化に失敗: {e}", exc_info=True)
-            raise
+        with client_init_lock:
+            if db_client is None:
+                try:
+                    if not firebase_admin._apps:
+                        firebase_admin.initialize_app()
+                    db_client = firestore.client()
+                    logging.info("Firestoreクライアントの初期化に成功しました。")
+                except Exception as e:
+                    logging.critical(f"Firebaseの初期化に失敗: {e}", exc_info=True)
+                    raise
     return db_client
 
-def get_pubsub_publisher() -> pubsub_v1.PublisherClient:
+def get_pubsub_publisher(batch_size: int) -> pubsub_v1.PublisherClient:
     """Pub/Sub Publisherクライアントをシングルトンとして初期化・取得する"""
+    # batch_sizeには検証済みのapp.config["BATCH_SIZE"]を渡す（初回呼び出し時の値で生成する）
     global publisher_client
     if publisher_client is None:
-        try:
-            publisher_client = pubsub_v1.PublisherClient()
-            logging.info("Pub/Sub Publisherの初期化に成功しました。")
-        except Exception as e:
-            logging.critical(f"Pub/Sub Publisherの初期化に失敗: {e}", exc_info=True)
-            raise
+        with client_init_lock:
+            if publisher_client is None:
+                try:
+                    # 1メッセージ毎にRPCを発行しないよう、クライアント側でバッチングさせる
+                    # （1チャンク分を1回のPublish RPCにまとめる）
+                    batch_settings = pubsub_v1.types.BatchSettings(
+                        max_messages=batch_size,
+                        max_bytes=9 * 1024 * 1024,
+                        max_latency=0.05,
+                    )
+                    # 発行が滞留した場合はメモリを増やし続けず、publish()の呼び出し側をブロックする
+                    publisher_options = pubsub_v1.types.PublisherOptions(
+                        enable_message_ordering=False,
+                        flow_control=pubsub_v1.types.PublishFlowControl(
+                            message_limit=10_000,
+                            byte_limit=100 * 1024 * 1024,
+                            limit_exceeded_behavior=pubsub_v1.types.LimitExceededBehavior.BLOCK,
+                        ),
+                    )
+                    publisher_client = pubsub_v1.PublisherClient(
+                        batch_settings=batch_settings, publisher_options=publisher_options
+                    )
+                    logging.info("Pub/Sub Publisherの初期化に成功しました。")
+                except Exception as e:
+                    logging.critical(f"Pub/Sub Publisherの初期化に失敗: {e}", exc_info=True)
+                    raise
     return publisher_client
 
 
+# ==============================================================================
+# Static Responses
+# ==============================================================================
+# 内容が固定のJSON本文は起動時に一度だけエンコードしておく
+MISSING_AUTH_HEADER_BODY = json.dumps(
+    {"status": "error", "message": "認証ヘッダーがありません"}
+).encode("utf-8")
+INVALID_TOKEN_BODY = json.dumps(
+    {"status": "error", "message": "無効な認証トークンです"}
+).encode("utf-8")
+INTERNAL_ERROR_BODY = json.dumps(
+    {"status": "error", "message": "内部サーバーエラー"}
+).encode("utf-8")
+HEALTHY_BODY = json.dumps({"status": "healthy"}).encode("utf-8")
+
+def static_json_response(body: bytes, status: int) -> Response:
+    """事前にエンコード済みのJSON本文からレスポンスを生成する"""
+    # Responseはリクエスト処理中に変更され得るため、インスタンスは共有せず毎回生成する
+    return Response(body, status=status, mimetype="application/json")
+
+
 # ==============================================================================
 # Application Factory
 # ==============================================================================
@@ -97,6 +154,37 @@ def create_app(config_class=Config):
         # 数値への型変換（ここでエラーが出ても捕捉できる）
         app.config["BATCH_SIZE"] = int(app.config["BATCH_SIZE"])
         app.config["MAX_DOCUMENTS_PER_REQUEST"] = int(app.config["MAX_DOCUMENTS_PER_REQUEST"])
+        app.config["PUBLISH_TIMEOUT_SECONDS"] = float(app.config["PUBLISH_TIMEOUT_SECONDS"])
+        app.config["MAX_CONCURRENT_CHUNKS"] = int(app.config["MAX_CONCURRENT_CHUNKS"])
+
+        # 1チャンク = 1回のWriteBatchコミットのため、Firestoreの上限（500件）内に収める
+        if not 1 <= app.config["BATCH_SIZE"] <= 500:
+            raise ValueError(
+                f"BATCH_SIZEは1〜500の範囲で指定してください: {app.config['BATCH_SIZE']}"
+            )
+        # クエリのlimitにそのまま渡すため、0以下（Firestoreが拒否する値）は起動時に弾く
+        if app.config["MAX_DOCUMENTS_PER_REQUEST"] < 1:
+            raise ValueError(
+                "MAX_DOCUMENTS_PER_REQUESTは1以上を指定してください: "
+                f"{app.config['MAX_DOCUMENTS_PER_REQUEST']}"
+            )
+        if app.config["MAX_CONCURRENT_CHUNKS"] < 1:
+            raise ValueError(
+                "MAX_CONCURRENT_CHUNKSは1以上を指定してください: "
+                f"{app.config['MAX_CONCURRENT_CHUNKS']}"
+            )
+        # 0以下では発行の完了を待たずに全件タイムアウト扱いとなるため、起動時に弾く
+        if app.config["PUBLISH_TIMEOUT_SECONDS"] <= 0:
+            raise ValueError(
+                "PUBLISH_TIMEOUT_SECONDSは0より大きい値を指定してください: "
+                f"{app.config['PUBLISH_TIMEOUT_SECONDS']}"
+            )
+
+        # トピックパスはプロセス中不変のため一度だけ組み立てる（SDKのtopic_pathと同形式）
+        app.config["TOPIC_PATH"] = (
+            f"projects/{app.config['GCP_PROJECT_ID']}"
+            f"/topics/{app.config['ARTICLE_PROCESSING_TOPIC_ID']}"
+        )
         
         app.logger.info("アプリケーションの設定読み込みと検証が完了しました。")
 
@@ -105,81 +193,168 @@ def create_app(config_class=Config):
         # コンテナをクラッシュさせて問題を知らせる
         raise
 
+    # リクエスト毎に参照する設定値は、検証後にクロージャのローカル変数として束ねておく
+    target_audience = app.config["TARGET_AUDIENCE"]
+    collection_name = app.config["COLLECTION_NAME"]
+    batch_size = app.config["BATCH_SIZE"]
+    max_documents_per_request = app.config["MAX_DOCUMENTS_PER_REQUEST"]
+    publish_timeout_seconds = app.config["PUBLISH_TIMEOUT_SECONDS"]
+    max_concurrent_chunks = app.config["MAX_CONCURRENT_CHUNKS"]
+    topic_path = app.config["TOPIC_PATH"]
+
     # --- Decorators ---
+    # 検証済みクレームを短時間だけ保持する（キーはハッシュ値とし、生のトークンは保持しない）
+    verified_claims_cache = cachetools.TTLCache(maxsize=1024, ttl=300)
+    verified_claims_lock = threading.Lock()
+
+    def verify_token(token: str) -> Dict[str, Any]:
+        """IDトークンを検証してクレームを返す（検証済みのトークンは再検証を省略する）"""
+        cache_key = hashlib.sha256(token.encode("utf-8")).digest()
+        with verified_claims_lock:
+            claims = verified_claims_cache.get(cache_key)
+        if claims is None:
+            claims = id_token.verify_oauth2_token(
+                token,
+                auth_request,
+                audience=target_audience,
+            )
+            with verified_claims_lock:
+                verified_claims_cache[cache_key] = claims
+        return claims
+
     def service_auth_required(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
             auth_header = request.headers.get("Authorization")
             if not auth_header or not auth_header.startswith("Bearer "):
-                return jsonify({"status": "error", "message": "認証ヘッダーがありません"}), 401
-            token = auth_header.split("Bearer ")[1]
+                return static_json_response(MISSING_AUTH_HEADER_BODY, 401)
+            token = auth_header[7:]  # len("Bearer ")
             try:
-                id_token.verify_oauth2_token(
-                    token,
-                    google.auth.transport.requests.Request(),
-                    audience=app.config["TARGET_AUDIENCE"],
-                )
+                claims = verify_token(token)
+                # キャッシュ済みのクレームは有効期限を過ぎても返るため、毎回確認する
+                if time.time() >= claims["exp"]:
+                    raise ValueError(f"Token expired, {claims['exp']} < {time.time()}")
             except ValueError as e:
                 app.logger.warning(f"無効な認証トークンです: {e}")
-                return jsonify({"status": "error", "message": "無効な認証トークンです"}), 403
+                return static_json_response(INVALID_TOKEN_BODY, 403)
             return f(*args, **kwargs)
         return decorated_function
 
     # --- Core Logic ---
-    @firestore.transactional
-    def update_docs_and_prepare_messages(transaction, docs_query, batch_id):
-        messages_to_publish = []
-        docs = docs_query.stream(transaction=transaction)
+    def mark_docs_as_queued(db, docs, batch_id):
+        """ドキュメントを'queued'に更新し、1回のバッチ書き込みでコミットする"""
+        # トランザクションによる読み取りは行わない代わりに、ストリームで取得した時点から
+        # 更新されていないことを前提条件とする。他のトリガーが先にキューへ追加し、
+        # 購読側が処理を進めた記事を'queued'へ巻き戻さないため。前提条件が崩れた場合は
+        # チャンク全体のコミットが失敗し、残りの記事は'received'のまま次回のトリガーで処理される。
+        batch = db.batch()
         for doc in docs:
-            if doc.to_dict().get("status") == "received":
-                doc_id = doc.id
-                message_payload = {"documentId": doc_id, "batchId": batch_id}
-                messages_to_publish.append(message_payload)
-                transaction.update(doc.reference, {
-                    "status": "queued",
-                    "queuedAt": firestore.SERVER_TIMESTAMP,
-                    "batchId": batch_id,
-                })
-        return messages_to_publish
+            batch.update(doc.reference, {
+                "status": "queued",
+                "queuedAt": firestore.SERVER_TIMESTAMP,
+                "batchId": batch_id,
+            }, option=db.write_option(last_update_time=doc.update_time))
+        batch.commit()
+
+    def abort_chunks(chunk_futures):
+        """未着手のチャンクを取り消し、実行中のチャンクとその発行の完了を待つ"""
+        # エラー応答を返した後に、記事の'queued'化や発行が裏で続かないようにする
+        for chunk_future in chunk_futures:
+            chunk_future.cancel()
+        concurrent.futures.wait(chunk_futures)
+        in_flight = [
+            publish_future
+            for chunk_future in chunk_futures
+            if not chunk_future.cancelled() and chunk_future.exception() is None
+            for publish_future in chunk_future.result()
+        ]
+        concurrent.futures.wait(in_flight, timeout=publish_timeout_seconds)
 
     # --- API Endpoints ---
     @app.route("/trigger-workflow", methods=["POST"])
     @service_auth_required
     def start_workflow():
-        batch_id = str(uuid.uuid4())
+        # 追跡用の相関IDのため96bitで十分（全メッセージに載るので短く保つ）
+        batch_id = secrets.token_hex(12)
         app.logger.info(f"ワークフロー開始リクエストを受信 (Batch ID: {batch_id})")
         total_processed = 0
         try:
             db = get_firestore_client()
-            publisher = get_pubsub_publisher()
-            topic_path = publisher.topic_path(
-                app.config["GCP_PROJECT_ID"], app.config["ARTICLE_PROCESSING_TOPIC_ID"]
+            publisher = get_pubsub_publisher(batch_size)
+            # batchIdはリクエスト内で不変のため、ペイロードの固定部分を事前にエンコードする
+            # （json.dumps({"documentId": ..., "batchId": ...}) と同一のバイト列になる）
+            payload_prefix = b'{"documentId": '
+            payload_suffix = f', "batchId": {json.dumps(batch_id)}}}'.encode("utf-8")
+
+            def queue_and_publish(docs):
+                """チャンクを'queued'に更新してから、各記事のメッセージを発行する"""
+                mark_docs_as_queued(db, docs, batch_id)
+                # 同じ値を属性にも載せ、購読側がJSONを解析せずに参照・フィルタできるようにする
+                # （既存の購読側との互換のため、JSON本文は当面維持する）
+                return [
+                    publisher.publish(
+                        topic_path,
+                        payload_prefix
+                        + encode_basestring_ascii(doc.id).encode("ascii")
+                        + payload_suffix,
+                        documentId=doc.id,
+                        batchId=batch_id,
+                    )
+                    for doc in docs
+                ]
+
+            # 対象を1回のクエリでストリームし、クライアント側でBATCH_SIZE件ずつ処理する
+            # フィールドは使わないため、空の射影でドキュメント名（__name__）だけを返させる
+            docs_stream = (
+                db.collection(collection_name)
+                .select([])
+                .where("status", "==", "received")
+                .limit(max_documents_per_request)
+                .stream()
             )
-            while total_processed < app.config["MAX_DOCUMENTS_PER_REQUEST"]:
-                docs_query = (
-                    db.collection(app.config["COLLECTION_NAME"])
-                    .where("status", "==", "received")
-                    .limit(app.config["BATCH_SIZE"])
-                )
-                transaction = db.transaction()
-                messages_to_publish = update_docs_and_prepare_messages(
-                    transaction, docs_query, batch_id
+            # ストリームの読み出しはこのスレッドで続け、各チャンクの処理はワーカーに任せる。
+            # プールはリクエスト毎に確保し、同時実行中の他のトリガーとワーカーを奪い合わない
+            # （gunicornワーカー1つあたり最大 threads × MAX_CONCURRENT_CHUNKS スレッド）。
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_concurrent_chunks, thread_name_prefix="chunk-worker"
+            ) as chunk_executor:
+                chunk_futures = []
+                try:
+                    while True:
+                        docs = list(itertools.islice(docs_stream, batch_size))
+                        if not docs:
+                            break
+                        chunk_futures.append(
+                            chunk_executor.submit(queue_and_publish, docs)
+                        )
+
+                    publish_futures = []
+                    for chunk_future in chunk_futures:
+                        chunk_publish_futures = chunk_future.result()
+                        publish_futures.extend(chunk_publish_futures)
+                        count = len(chunk_publish_futures)
+                        total_processed += count
+                        app.logger.debug(
+                            f"{count}件の記事をキューに追加しました。(Batch ID: {batch_id})"
+                        )
+                except Exception:
+                    abort_chunks(chunk_futures)
+                    raise
+
+            # 発行の完了確認はリクエスト末尾で一度だけ行い、後続チャンクの処理と重ねる。
+            # 確認前に応答すると、発行失敗時に記事が'queued'のまま取り残される。
+            done, not_done = concurrent.futures.wait(
+                publish_futures, timeout=publish_timeout_seconds
+            )
+            failed = [future for future in done if future.exception() is not None]
+            if failed or not_done:
+                raise RuntimeError(
+                    f"Pub/Subへの発行に失敗しました "
+                    f"(失敗: {len(failed)}件, タイムアウト: {len(not_done)}件)"
                 )
-                if not messages_to_publish:
-                    app.logger.info(f"処理対象の記事が見つかりませんでした。(Batch ID: {batch_id})")
-                    break
-                
-                futures = [
-                    publisher.publish(topic_path, json.dumps(msg).encode("utf-8"))
-                    for msg in messages_to_publish
-                ]
-                for future in futures:
-                    future.result()
-                
-                count = len(messages_to_publish)
-                total_processed += count
-                app.logger.info(f"{count}件の記事をキューに追加しました。(Batch ID: {batch_id})")
 
+            if total_processed == 0:
+                app.logger.info(f"処理対象の記事が見つかりませんでした。(Batch ID: {batch_id})")
             message = f"ワークフローを開始し、合計{total_processed}件の記事をキューに追加しました。"
             app.logger.info(f"{message} (Batch ID: {batch_id})")
             return jsonify({
@@ -190,11 +365,12 @@ def create_app(config_class=Config):
             app.logger.error(
                 f"ワークフロー実行中にエラー (Batch ID: {batch_id}): {e}", exc_info=True
             )
-            return jsonify({"status": "error", "message": "内部サーバーエラー"}), 500
+            return static_json_response(INTERNAL_ERROR_BODY, 500)
 
     @app.route("/health", methods=["GET"])
     def health_check():
-        return jsonify({"status": "healthy"}), 200
+        # livenessプローブ用。コールドスタート中に遅延しないよう、クライアントには触れない
+        return static_json_response(HEALTHY_BODY, 200)
 
     return app
 
@@ -0,0 +1,13 @@
+# ==============================================================================
+# Memory Library - Manual Workflow Trigger Service
+# tests/conftest.py
+#
+# Role:         main.pyはインポート時にアプリを生成するため、必須の環境変数を
+#               インポート前に設定しておく。
+# ==============================================================================
+import os
+
+os.environ.setdefault("GCP_PROJECT_ID", "test-project")
+os.environ.setdefault("ARTICLE_PROCESSING_TOPIC_ID", "test-topic")
+os.environ.setdefault("AUDIENCE", "https://test.example.com")
+os.environ.setdefault("BATCH_SIZE", "2")
@@ -0,0 +1,135 @@
+# ==============================================================================
+# Memory Library - Manual Workflow Trigger Service
+# tests/test_main.py
+#
+# Role:         実際のFirestoreクエリ/WriteBatchを使い、RPC（stream/commit）と
+#               Pub/Sub発行のみを差し替えてstart_workflowを通しで検証する。
+# ==============================================================================
+import concurrent.futures
+import datetime
+import json
+import time
+
+import pytest
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import firestore as gcloud_firestore
+from google.cloud.firestore_v1.batch import WriteBatch
+from google.cloud.firestore_v1.document import DocumentSnapshot
+from google.cloud.firestore_v1.query import Query
+
+import main
+
+UPDATE_TIME = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+AUTH_HEADERS = {"Authorization": "Bearer test-token"}
+
+
+class FakePublisher:
+    """publish()の呼び出しを記録し、完了済みのFutureを返すPublisherの代替"""
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, data, **attrs):
+        self.published.append((topic, data, attrs))
+        future = concurrent.futures.Future()
+        future.set_result("message-id")
+        return future
+
+
+@pytest.fixture
+def db():
+    return gcloud_firestore.Client(project="test-project", credentials=AnonymousCredentials())
+
+
+@pytest.fixture
+def env(monkeypatch, db):
+    """Firestore/Pub/Subへの通信部分だけを差し替えたテスト環境を用意する"""
+    state = {"doc_ids": ["a", "b", "c"], "queries": [], "commits": [], "fail_commit": False}
+    publisher = FakePublisher()
+
+    def fake_stream(query, *args, **kwargs):
+        state["queries"].append(query._to_protobuf())
+        for doc_id in state["doc_ids"]:
+            reference = db.collection(main.Config.COLLECTION_NAME).document(doc_id)
+            yield DocumentSnapshot(reference, {}, True, UPDATE_TIME, UPDATE_TIME, UPDATE_TIME)
+
+    def fake_commit(batch, *args, **kwargs):
+        if state["fail_commit"]:
+            raise RuntimeError("commit failed")
+        state["commits"].append(list(batch._write_pbs))
+        return []
+
+    monkeypatch.setattr(Query, "stream", fake_stream)
+    monkeypatch.setattr(WriteBatch, "commit", fake_commit)
+    monkeypatch.setattr(main, "get_firestore_client", lambda: db)
+    monkeypatch.setattr(main, "get_pubsub_publisher", lambda batch_size: publisher)
+    monkeypatch.setattr(
+        main.id_token, "verify_oauth2_token",
+        lambda token, request, audience: {"exp": time.time() + 3600},
+    )
+    state["publisher"] = publisher
+    return state
+
+
+def test_trigger_workflow_queues_and_publishes_all_documents(env):
+    response = main.app.test_client().post("/trigger-workflow", headers=AUTH_HEADERS)
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["processedCount"] == 3
+    batch_id = body["batchId"]
+
+    # クエリはドキュメント名のみの射影で、1回だけ発行される
+    assert len(env["queries"]) == 1
+    assert [f.field_path for f in env["queries"][0].select.fields] == ["__name__"]
+
+    # BATCH_SIZE=2のため2チャンクに分かれ、各更新に更新時刻の前提条件が付く
+    assert sorted(len(writes) for writes in env["commits"]) == [1, 2]
+    for writes in env["commits"]:
+        for write in writes:
+            assert write.update.fields["status"].string_value == "queued"
+            assert write.current_document.update_time is not None
+
+    # 本文はjson.dumpsと同一のバイト列で、同じ値が属性にも載る
+    published = sorted(env["publisher"].published, key=lambda p: p[2]["documentId"])
+    assert [p[2]["documentId"] for p in published] == ["a", "b", "c"]
+    for topic, data, attrs in published:
+        assert topic == "projects/test-project/topics/test-topic"
+        assert data == json.dumps(
+            {"documentId": attrs["documentId"], "batchId": batch_id}
+        ).encode("utf-8")
+        assert attrs["batchId"] == batch_id
+
+
+def test_trigger_workflow_returns_500_without_publishing_when_commit_fails(env):
+    env["fail_commit"] = True
+
+    response = main.app.test_client().post("/trigger-workflow", headers=AUTH_HEADERS)
+
+    assert response.status_code == 500
+    assert env["publisher"].published == []
+
+
+def test_trigger_workflow_requires_bearer_token(env):
+    response = main.app.test_client().post("/trigger-workflow")
+
+    assert response.status_code == 401
+    assert env["queries"] == []
+
+
+@pytest.mark.parametrize(
+    "name, value",
+    [
+        ("BATCH_SIZE", "0"),
+        ("BATCH_SIZE", "501"),
+        ("MAX_DOCUMENTS_PER_REQUEST", "0"),
+        ("MAX_DOCUMENTS_PER_REQUEST", "-1"),
+        ("MAX_CONCURRENT_CHUNKS", "0"),
+        ("PUBLISH_TIMEOUT_SECONDS", "0"),
+    ],
+)
+def test_create_app_rejects_out_of_range_settings(name, value):
+    config_class = type("InvalidConfig", (main.Config,), {name: value})
+
+    with pytest.raises(ValueError, match=name):
+        main.create_app(config_class)